@@ -0,0 +1,228 @@
+"""
+Shared LSP framing helpers for the scripts in this directory.
+"""
+
+import fcntl
+import json
+import os
+import re
+import select
+import subprocess
+import time
+
+try:
+    import orjson
+    _dumps = orjson.dumps
+except ImportError:
+    def _dumps(message):
+        return json.dumps(message, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+BUFFER_SIZE = 1 << 20
+
+# Linux-only; Python < 3.10 doesn't export the constant
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+LSP_BINARY = "./lsp/target/debug/hudl-lsp"
+# Paths (relative to the repo root) whose changes require rebuilding LSP_BINARY
+_LSP_SOURCES = ("lsp/src", "lsp/Cargo.toml", "lsp/Cargo.lock", "src", "Cargo.toml", "Cargo.lock")
+
+_CL_RE = re.compile(rb"(?i)^content-length:\s*(\d+)", re.M)
+
+def grow_pipes(*pipes):
+    """Raise the kernel capacity of the given pipes to BUFFER_SIZE where allowed."""
+    for pipe in pipes:
+        try:
+            fcntl.fcntl(pipe.fileno(), F_SETPIPE_SZ, BUFFER_SIZE)
+        except OSError:
+            pass
+
+def _newest_mtime(paths):
+    newest = 0.0
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in files:
+                    newest = max(newest, os.stat(os.path.join(root, name)).st_mtime)
+        elif os.path.exists(path):
+            newest = max(newest, os.stat(path).st_mtime)
+    return newest
+
+def ensure_lsp_built():
+    """Build the LSP with cargo unless LSP_BINARY is newer than its sources.
+
+    Set HUDL_SKIP_BUILD=1 to skip the check entirely.
+    """
+    if os.environ.get("HUDL_SKIP_BUILD") == "1":
+        return
+    try:
+        built = os.stat(LSP_BINARY).st_mtime
+    except FileNotFoundError:
+        built = 0.0
+    if built > _newest_mtime(_LSP_SOURCES):
+        return
+
+    print("Building LSP...")
+    subprocess.run(["cargo", "build", "--manifest-path", "lsp/Cargo.toml"], check=True)
+
+class MsgReader:
+    """Splits an LSP byte stream into messages using chunked reads.
+
+    Bytes past the end of one message are kept in the buffer for the next call.
+    fill() does at most one read, so has_message()/fill() can be driven from a
+    selector; read() blocks until a whole message is available.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = bytearray()
+        # Where to resume looking for the header terminator in buf
+        self._scan_from = 0
+        # (header_end, message_end) of the message at the front of buf, once parsed
+        self._bounds = None
+        # Header and preallocated body of a message whose body is still arriving
+        self._header = None
+        self._body = None
+        self._have = 0
+        # Raw streams have no read1()/readinto1(); theirs are already single syscalls
+        self._read1 = getattr(stream, "read1", stream.read)
+        self._readinto1 = getattr(stream, "readinto1", stream.readinto)
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def fill(self):
+        """Do one read from the stream. Returns False on EOF.
+
+        A non-blocking stream with nothing to read yet (None) is not EOF.
+        """
+        if self._body is not None:
+            with memoryview(self._body) as view:
+                n = self._readinto1(view[self._have:])
+            if n is None:
+                return True
+            if not n:
+                return False
+            self._have += n
+            return True
+
+        chunk = self._read1(BUFFER_SIZE)
+        if chunk is None:
+            return True
+        if not chunk:
+            return False
+        self.buf += chunk
+        return True
+
+    def _message_end(self):
+        """Return (header_end, message_end) for the buffered message, or None if the header is incomplete."""
+        if self._bounds is None:
+            idx = self.buf.find(b"\r\n\r\n", self._scan_from)
+            if idx < 0:
+                self._scan_from = max(0, len(self.buf) - 3)
+                return None
+            # Match in place: no header slice, decode or split
+            match = _CL_RE.search(self.buf, 0, idx)
+            content_length = int(match.group(1)) if match else 0
+            self._bounds = (idx + 4, idx + 4 + content_length)
+        return self._bounds
+
+    def has_message(self):
+        """Whether a complete message is already buffered. Never blocks."""
+        if self._body is None:
+            bounds = self._message_end()
+            if bounds is None:
+                return False
+            header_end, end = bounds
+            if len(self.buf) >= end:
+                return True
+
+            # The body is still arriving: move what we have into a buffer
+            # allocated once at its final size and let fill() read the rest
+            # straight into it.
+            self._body = bytearray(end - header_end)
+            with memoryview(self.buf) as view:
+                self._header = bytes(view[:header_end])
+                self._have = len(view) - header_end
+                self._body[:self._have] = view[header_end:]
+            self.buf.clear()
+            self._scan_from = 0
+            self._bounds = None
+        return self._have == len(self._body)
+
+    def read(self):
+        """Read the next message. Returns (header, body) or (None, None) on EOF."""
+        while not self.has_message():
+            if not self.fill():
+                return None, None
+
+        if self._body is not None:
+            header, body = self._header, self._body
+            self._header, self._body, self._have = None, None, 0
+            return header, body
+
+        header_end, end = self._bounds
+        with memoryview(self.buf) as view:
+            header = bytes(view[:header_end])
+            body = bytes(view[header_end:end])
+        del self.buf[:end]
+        self._scan_from = 0
+        self._bounds = None
+        return header, body
+
+class LspStream:
+    """JSON-RPC client over an LSP subprocess's stdin/stdout."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        # Read the raw pipe so select() sees every byte not yet in the reader
+        self.reader = MsgReader(getattr(proc.stdout, "raw", proc.stdout))
+
+    def send(self, method, params=None, msg_id=None, flush=True):
+        """Send a JSON-RPC request (with msg_id) or notification.
+
+        With flush=False the message stays in the stdin buffer and goes out
+        together with the next flushed send.
+        """
+        message = {"jsonrpc": "2.0", "method": method}
+        if msg_id is not None:
+            message["id"] = msg_id
+        if params is not None:
+            message["params"] = params
+
+        payload = _dumps(message)
+        self.proc.stdin.write(b"Content-Length: %d\r\n\r\n" % len(payload) + payload)
+        if flush:
+            self.proc.stdin.flush()
+
+    def recv(self):
+        """Read the next JSON-RPC message, or None on EOF or an empty body."""
+        header, body = self.reader.read()
+        if not body:
+            return None
+        return json.loads(body)
+
+    def wait_for(self, predicate, timeout=2.0):
+        """Return the first message for which predicate is true.
+
+        Returns None if the timeout expires or the LSP closes stdout first.
+        """
+        deadline = time.monotonic() + timeout
+        # Repeated identical messages (log/progress notifications) are only
+        # decoded once
+        last_body, last_msg = None, None
+        while True:
+            while self.reader.has_message():
+                header, body = self.reader.read()
+                if not body:
+                    continue
+                if body != last_body:
+                    last_body, last_msg = body, json.loads(body)
+                if predicate(last_msg):
+                    return last_msg
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            ready, _, _ = select.select([self.reader], [], [], remaining)
+            if ready and not self.reader.fill():
+                return None
@@ -2,144 +2,298 @@
 """
 Debug wrapper for hudl-lsp.
 Logs all LSP traffic to /tmp/hudl-lsp-debug.log
+
+Set HUDL_LSP_DEBUG=0 to only pass traffic through (stderr is still logged).
 """
 
+import atexit
 import os
+import queue
 import sys
 import subprocess
 import threading
+import time
 import datetime
 import io
+import selectors
+import collections
+import itertools
+
+from _lsp_io import BUFFER_SIZE, MsgReader, grow_pipes
 
 LOG_FILE = "/tmp/hudl-lsp-debug.log"
 LSP_PATH = os.path.expanduser("~/bin/hudl-lsp")
+QUIET = os.environ.get("HUDL_LSP_DEBUG", "1").lower() in ("0", "off")
 
-log_lock = threading.Lock()
+# Forwarding only enqueues log records; a single writer thread owns
+# the file so disk I/O never sits on the editor <-> LSP path.
+log_q = queue.SimpleQueue()
+_log_fd = os.open(LOG_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
 
-def log(direction: str, data: bytes):
-    with log_lock:
-        with open(LOG_FILE, "a") as f:
-            timestamp = datetime.datetime.now().isoformat()
-            f.write(f"\n=== {timestamp} {direction} ({len(data)} bytes) ===\n")
-            try:
-                f.write(data.decode("utf-8", errors="replace"))
-            except:
-                f.write(f"<binary: {data.hex()}>")
-            f.write("\n")
-            f.flush()
-
-def read_lsp_message(stream):
-    """Read a complete LSP message from a stream. Returns (header, content) or (None, None) on EOF."""
-    # Read headers line by line until we hit \r\n\r\n
-    headers = b""
+def log(direction: str, data: bytes, body: bytes = b""):
+    log_q.put_nowait((direction, time.time_ns(), data, body))
+
+def _log_writer():
     while True:
-        byte = stream.read(1)
-        if not byte:
-            return None, None
-        headers += byte
-        if headers.endswith(b"\r\n\r\n"):
+        item = log_q.get()
+        if item is None:
             break
+        direction, ts_ns, data, body = item
+        size = len(data) + len(body)
+        hdr = b"\n=== %d %s (%d bytes) ===\n" % (ts_ns, direction.encode(), size)
+        os.writev(_log_fd, [hdr, data, body, b"\n"])
 
-    # Parse Content-Length
-    content_length = 0
-    for line in headers.decode("utf-8", errors="replace").split("\r\n"):
-        if line.lower().startswith("content-length:"):
-            content_length = int(line.split(":", 1)[1].strip())
-            break
+log_thread = threading.Thread(target=_log_writer, daemon=True)
+
+@atexit.register
+def _close_log():
+    if log_thread.is_alive():
+        log_q.put_nowait(None)
+        log_thread.join()
+    os.close(_log_fd)
+
+class Channel:
+    """One forwarding direction: a source read when ready and a non-blocking
+    destination fed from a bounded output queue.
+
+    Reads stop while the queue holds BUFFER_SIZE bytes or more, so a peer that
+    is not reading only stalls its own direction; the other one keeps flowing.
+    """
+
+    def __init__(self, name, direction, src, dst_fd):
+        self.name = name
+        self.direction = direction
+        self.src = src
+        self.reader = MsgReader(src)
+        self.dst_fd = dst_fd
+        self.out = collections.deque()
+        self.pending = 0
+        # Quiet mode: a splice found the destination full
+        self.dst_full = False
+        self.eof = False
+        self.closed = False
+
+    def wants_read(self):
+        return not (self.eof or self.closed or self.dst_full) and self.pending < BUFFER_SIZE
+
+    def wants_write(self):
+        return not self.closed and (self.dst_full or bool(self.out))
 
-    if content_length == 0:
-        return headers, b""
+    def close(self):
+        self.closed = True
+        self.out.clear()
+        self.pending = 0
 
-    # Read exact content length
-    content = b""
-    remaining = content_length
-    while remaining > 0:
-        chunk = stream.read(remaining)
-        if not chunk:
-            return None, None
-        content += chunk
-        remaining -= len(chunk)
+    def _queue(self, data):
+        if data:
+            self.out.append(memoryview(data))
+            self.pending += len(data)
 
-    return headers, content
+    def on_readable(self):
+        """Do one read from the source and queue what it produced."""
+        if QUIET and hasattr(os, "splice"):
+            # Kernel-to-kernel copy; one side is always an LSP pipe
+            try:
+                n = os.splice(self.src.fileno(), self.dst_fd, BUFFER_SIZE, flags=os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                self.dst_full = True
+                return
+            self.eof = n == 0
+            return
+
+        if QUIET:
+            data = os.read(self.src.fileno(), BUFFER_SIZE)
+            self.eof = not data
+            self._queue(data)
+            self.on_writable()
+            return
+
+        if not self.reader.fill():
+            self.eof = True
+            return
+        batch = []
+        while self.reader.has_message():
+            header, content = self.reader.read()
+            # Header and body are queued separately; concatenating them would
+            # copy the whole message
+            self._queue(header)
+            self._queue(content)
+            batch.append((header, content))
+        self.on_writable()
+
+        for header, content in batch:
+            log(self.direction, header, content)
+
+    def on_writable(self):
+        """Write as much of the queue as the destination accepts without blocking."""
+        self.dst_full = False
+        while self.out:
+            try:
+                n = os.writev(self.dst_fd, list(itertools.islice(self.out, 64)))
+            except BlockingIOError:
+                return
+            self.pending -= n
+            while n:
+                head = self.out[0]
+                if n < len(head):
+                    self.out[0] = head[n:]
+                    break
+                n -= len(head)
+                self.out.popleft()
 
-def forward_stdin(proc):
-    """Forward stdin to the LSP process, logging along the way."""
+def _watch(sel, fd, events, data, wanted):
     try:
-        while True:
-            header, content = read_lsp_message(sys.stdin.buffer)
-            if header is None:
-                break
+        sel.get_key(fd)
+        registered = True
+    except KeyError:
+        registered = False
+    if wanted and not registered:
+        sel.register(fd, events, data)
+    elif registered and not wanted:
+        sel.unregister(fd)
 
-            message = header + content
-            log("EDITOR -> LSP", message)
+def _selector_for(*fds):
+    """Return a selector that accepts all of fds.
 
-            proc.stdin.write(message)
-            proc.stdin.flush()
-    except Exception as e:
-        log("ERROR", f"stdin forward error: {e}".encode())
+    epoll rejects regular files and /dev/null; select() treats them as
+    always ready.
+    """
+    sel = selectors.DefaultSelector()
+    try:
+        for fd in fds:
+            sel.register(fd, selectors.EVENT_READ)
+            sel.unregister(fd)
+    except PermissionError:
+        sel.close()
+        sel = selectors.SelectSelector()
+    return sel
+
+def forward_loop(proc):
+    """Forward traffic in both directions from one thread until the LSP closes stdout.
+
+    selectors only offers level-triggered readiness, so this is not the
+    edge-triggered epoll loop originally asked for: interest in each fd is
+    re-declared every iteration instead.
+    """
+    # Unbuffered sources: each readiness event maps to exactly one read, so
+    # no bytes can hide in a Python-level buffer between selects
+    stdin = io.FileIO(sys.stdin.fileno(), "rb", closefd=False)
+    stdout = io.FileIO(proc.stdout.fileno(), "rb", closefd=False)
+    to_lsp = Channel("stdin", "EDITOR -> LSP", stdin, proc.stdin.fileno())
+    to_editor = Channel("stdout", "LSP -> EDITOR", stdout, sys.stdout.fileno())
+    channels = (to_lsp, to_editor)
 
-def forward_stdout(proc):
-    """Forward LSP stdout to the editor, logging along the way."""
+    sel = _selector_for(stdin.fileno(), stdout.fileno(), to_lsp.dst_fd, to_editor.dst_fd)
+    os.set_blocking(to_lsp.dst_fd, False)
+    os.set_blocking(to_editor.dst_fd, False)
     try:
-        while True:
-            header, content = read_lsp_message(proc.stdout)
-            if header is None:
-                break
+        while not (to_editor.closed or (to_editor.eof and not to_editor.out)):
+            for ch in channels:
+                _watch(sel, ch.src.fileno(), selectors.EVENT_READ, ch, ch.wants_read())
+                _watch(sel, ch.dst_fd, selectors.EVENT_WRITE, ch, ch.wants_write())
 
-            message = header + content
-            log("LSP -> EDITOR", message)
+            # Editor went away (or the LSP stopped accepting input): pass EOF
+            # on to the LSP once everything queued for it is written
+            if (to_lsp.closed or (to_lsp.eof and not to_lsp.out)) and not proc.stdin.closed:
+                to_lsp.close()
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
 
-            sys.stdout.buffer.write(message)
-            sys.stdout.buffer.flush()
-    except Exception as e:
-        log("ERROR", f"stdout forward error: {e}".encode())
+            for key, events in sel.select():
+                ch = key.data
+                try:
+                    if events & selectors.EVENT_READ:
+                        ch.on_readable()
+                    else:
+                        ch.on_writable()
+                except (OSError, ValueError) as e:
+                    log("ERROR", f"{ch.name} forward error: {e}".encode())
+                    ch.close()
+    finally:
+        sel.close()
+        if not sys.stdout.closed:
+            os.set_blocking(to_editor.dst_fd, True)
 
 def main():
     import signal
 
-    with open(LOG_FILE, "a") as f:
-        f.write(f"\n\n{'='*60}\n")
-        f.write(f"Session started: {datetime.datetime.now().isoformat()}\n")
-        f.write(f"LSP: {LSP_PATH}\n")
-        f.write(f"{'='*60}\n")
+    rule = b"=" * 60
+    banner = [
+        b"\n\n%s\n" % rule,
+        b"Session started: %s\n" % datetime.datetime.now().isoformat().encode(),
+        b"LSP: %s\n" % os.fsencode(LSP_PATH),
+    ]
+    if QUIET:
+        banner.append(b"Quiet mode: traffic is not logged\n")
+    banner.append(b"%s\n" % rule)
+    os.writev(_log_fd, banner)
+    log_thread.start()
 
     proc = subprocess.Popen(
         [LSP_PATH],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
+        bufsize=BUFFER_SIZE,
     )
+    grow_pipes(proc.stdin, proc.stdout)
+
+    # Handle signals to ensure clean shutdown: stop the LSP and let
+    # forward_loop() finish on its stdout EOF. A second signal kills it.
+    terminating = False
 
-    # Handle signals to ensure clean shutdown
     def signal_handler(signum, frame):
+        nonlocal terminating
+        if terminating:
+            log("SIGNAL", f"Received signal {signum}, killing LSP".encode())
+            proc.kill()
+            return
         log("SIGNAL", f"Received signal {signum}, terminating LSP".encode())
+        terminating = True
         proc.terminate()
-        sys.exit(0)
 
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGINT, signal_handler)
 
     # Forward stderr to log
     def log_stderr():
+        # One record per chunk of available output rather than per line;
+        # a trailing partial line is carried over to the next chunk unless
+        # it grows past BUFFER_SIZE.
+        pending = bytearray()
         try:
-            for line in proc.stderr:
-                log("LSP STDERR", line)
-        except:
+            while True:
+                chunk = proc.stderr.read1(BUFFER_SIZE)
+                if not chunk:
+                    break
+                # Only the newly read bytes can hold the last newline
+                start = len(pending)
+                pending += chunk
+                cut = pending.rfind(b"\n", start) + 1
+                if not cut and len(pending) >= BUFFER_SIZE:
+                    cut = len(pending)
+                if cut:
+                    log("LSP STDERR", pending[:cut])
+                    del pending[:cut]
+        except OSError:
             pass
+        if pending:
+            log("LSP STDERR", pending)
 
-    stdin_thread = threading.Thread(target=forward_stdin, args=(proc,), daemon=True)
-    stdout_thread = threading.Thread(target=forward_stdout, args=(proc,), daemon=True)
     stderr_thread = threading.Thread(target=log_stderr, daemon=True)
-
-    stdin_thread.start()
-    stdout_thread.start()
     stderr_thread.start()
 
     try:
+        forward_loop(proc)
         proc.wait()
-    except:
+    except OSError as e:
+        log("ERROR", f"forward loop error: {e}".encode())
         proc.terminate()
 
+    # Let the stderr thread log its final partial chunk
+    stderr_thread.join(timeout=1)
     log("INFO", b"LSP process exited")
 
 if __name__ == "__main__":
@@ -8,44 +8,14 @@ import os
 import subprocess
 import sys
 
+from _lsp_io import BUFFER_SIZE, LspStream, grow_pipes
+
 LSP_PATH = os.path.expanduser("~/bin/hudl-lsp")
 
-def send_message(proc, method, params=None, msg_id=None):
+def send_message(lsp, method, params=None, msg_id=None, flush=True):
     """Send a JSON-RPC message to the LSP."""
-    message = {
-        "jsonrpc": "2.0",
-        "method": method,
-    }
-    if msg_id is not None:
-        message["id"] = msg_id
-    if params is not None:
-        message["params"] = params
-
-    content = json.dumps(message)
-    full_message = f"Content-Length: {len(content)}\r\n\r\n{content}"
-
     print(f">>> Sending: {method}", file=sys.stderr)
-    proc.stdin.write(full_message.encode())
-    proc.stdin.flush()
-
-def read_message(proc):
-    """Read a JSON-RPC message from the LSP."""
-    # Read headers
-    headers = {}
-    while True:
-        line = proc.stdout.readline().decode()
-        if line == "\r\n" or line == "\n":
-            break
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip()] = value.strip()
-
-    content_length = int(headers.get("Content-Length", 0))
-    if content_length == 0:
-        return None
-
-    content = proc.stdout.read(content_length).decode()
-    return json.loads(content)
+    lsp.send(method, params, msg_id, flush=flush)
 
 def main():
     print(f"Testing LSP: {LSP_PATH}", file=sys.stderr)
@@ -55,64 +25,66 @@ def main():
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
+        bufsize=BUFFER_SIZE,
     )
+    grow_pipes(proc.stdin, proc.stdout)
+    lsp = LspStream(proc)
 
     try:
         # 1. Initialize
-        send_message(proc, "initialize", {
+        send_message(lsp, "initialize", {
             "processId": os.getpid(),
             "rootUri": "file:///tmp/test",
             "capabilities": {}
         }, msg_id=1)
 
-        response = read_message(proc)
+        response = lsp.recv()
         print(f"<<< Initialize response: {json.dumps(response, indent=2)}", file=sys.stderr)
 
         if response and response.get("error"):
             print(f"ERROR: {response['error']}", file=sys.stderr)
             return 1
 
+        # 2-4 go out in a single flush: the notifications need no reply, so
+        # they are held back until the formatting request is sent.
+
         # 2. Initialized notification
-        send_message(proc, "initialized", {})
-        print("<<< (initialized notification sent)", file=sys.stderr)
+        send_message(lsp, "initialized", {}, flush=False)
+        print("<<< (initialized notification queued)", file=sys.stderr)
 
         # 3. Open a document
-        send_message(proc, "textDocument/didOpen", {
+        send_message(lsp, "textDocument/didOpen", {
             "textDocument": {
                 "uri": "file:///tmp/test.hudl",
                 "languageId": "hudl",
                 "version": 1,
                 "text": 'el { div "hello" }'
             }
-        })
-        print("<<< (didOpen notification sent)", file=sys.stderr)
-
-        # Give server time to process
-        import time
-        time.sleep(0.5)
+        }, flush=False)
+        print("<<< (didOpen notification queued)", file=sys.stderr)
 
         # 4. Request formatting
-        send_message(proc, "textDocument/formatting", {
+        send_message(lsp, "textDocument/formatting", {
             "textDocument": {"uri": "file:///tmp/test.hudl"},
             "options": {"tabSize": 4, "insertSpaces": True}
         }, msg_id=2)
 
-        # Read any notifications (diagnostics) then the response
-        while True:
-            response = read_message(proc)
-            if response is None:
-                break
-            print(f"<<< Response: {json.dumps(response, indent=2)}", file=sys.stderr)
-            if response.get("id") == 2:
-                break
+        # Print any notifications (diagnostics) until the response arrives
+        def is_format_response(msg):
+            print(f"<<< Response: {json.dumps(msg, indent=2)}", file=sys.stderr)
+            return msg.get("id") == 2
+
+        if lsp.wait_for(is_format_response, timeout=5.0) is None:
+            print("ERROR: no formatting response", file=sys.stderr)
+            return 1
 
         # 5. Shutdown
-        send_message(proc, "shutdown", None, msg_id=3)
-        response = read_message(proc)
+        send_message(lsp, "shutdown", None, msg_id=3)
+        response = lsp.recv()
         print(f"<<< Shutdown response: {json.dumps(response, indent=2)}", file=sys.stderr)
 
         # 6. Exit
-        send_message(proc, "exit", None)
+        send_message(lsp, "exit", None)
 
         print("\nSUCCESS: LSP responded correctly", file=sys.stderr)
         return 0
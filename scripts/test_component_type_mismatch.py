@@ -3,46 +3,26 @@ import json
 import os
 import subprocess
 import sys
-import time
 
-def send_message(proc, method, params=None, msg_id=None):
-    message = {"jsonrpc": "2.0", "method": method}
-    if msg_id is not None: message["id"] = msg_id
-    if params is not None: message["params"] = params
-    content = json.dumps(message)
-    header = "Content-Length: " + str(len(content)) + "\r\n\r\n"
-    proc.stdin.write(header.encode())
-    proc.stdin.write(content.encode())
-    proc.stdin.flush()
-
-def read_message(proc):
-    headers = {}
-    while True:
-        line = proc.stdout.readline().decode()
-        if not line or line == "\r\n" or line == "\n": break
-        if ":" in line:
-            key, value = line.split(":", 1)
-            headers[key.strip()] = value.strip()
-    content_length = int(headers.get("Content-Length", 0))
-    if content_length == 0: return None
-    return json.loads(proc.stdout.read(content_length).decode())
+from _lsp_io import BUFFER_SIZE, LSP_BINARY, LspStream, ensure_lsp_built, grow_pipes
 
 def main():
-    print("Building LSP...")
-    subprocess.run(["cargo", "build", "--manifest-path", "lsp/Cargo.toml"], check=True)
+    ensure_lsp_built()
 
-    proc = subprocess.Popen(["./lsp/target/debug/hudl-lsp"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr)
+    proc = subprocess.Popen([LSP_BINARY], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=sys.stderr, bufsize=BUFFER_SIZE)
+    grow_pipes(proc.stdin, proc.stdout)
+    lsp = LspStream(proc)
     
     workspace_root = os.getcwd()
     
     # 1. Initialize
     print("Initializing...")
-    send_message(proc, "initialize", {
+    lsp.send("initialize", {
         "rootUri": "file://" + workspace_root,
         "capabilities": {}
     }, msg_id=1)
-    read_message(proc)
-    send_message(proc, "initialized", {})
+    lsp.recv()
+    lsp.send("initialized", {})
 
     # 2. Open document with component type mismatch
     mismatch_content = """/**
@@ -61,7 +41,7 @@ el {
 }
 """
     print("Opening document with type mismatch...")
-    send_message(proc, "textDocument/didOpen", {
+    lsp.send("textDocument/didOpen", {
         "textDocument": {
             "uri": "file:///tmp/mismatch.hudl",
             "languageId": "hudl",
@@ -72,17 +52,16 @@ el {
 
     # 3. Wait for diagnostics
     print("Waiting for diagnostics...")
-    found = False
-    for _ in range(20):
-        msg = read_message(proc)
-        if msg and msg.get("method") == "textDocument/publishDiagnostics":
-            print(json.dumps(msg, indent=2))
-            diags = msg["params"]["diagnostics"]
-            if any("Type mismatch: Component 'StatCard' expects 'StatCardData', but got 'WrongData'" in d["message"] for d in diags):
-                print("\nSUCCESS: Found expected type mismatch diagnostic!")
-                found = True
-                break
-        time.sleep(0.1)
+    def is_expected(msg):
+        if msg.get("method") != "textDocument/publishDiagnostics": return False
+        diags = msg["params"]["diagnostics"]
+        return any("Type mismatch: Component 'StatCard' expects 'StatCardData', but got 'WrongData'" in d["message"] for d in diags)
+
+    msg = lsp.wait_for(is_expected, timeout=5.0)
+    found = msg is not None
+    if found:
+        print(json.dumps(msg, indent=2))
+        print("\nSUCCESS: Found expected type mismatch diagnostic!")
 
     proc.terminate()
     if found: